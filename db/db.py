@@ -4,133 +4,198 @@
 
 import csv
 import datetime
-import psycopg2
+import mmap
+import multiprocessing
+import numpy as np
+import os
+import psycopg
 import re
 import sys
-
-class Airport:
+from typing import NamedTuple
+
+# length of the mandatory data section of an ISD record, shorter lines carry no usable data
+_ISD_MANDATORY_LEN = 105
+# regex for a whole ISD record, additional (optional) data starts right after the fixed width mandatory data section
+# it is run over the contents of a file at once, every match is a record at the beginning of a line
+_RE_RECORD = re.compile(
+    rb"^(?:.{15})"  # length of the data, station ID in USAF and WBAN format
+    rb"(?P<date>[0-9]{8})"  # date in format YYYYMMDD
+    rb"(?P<time>[0-9]{4})"  # time in format HHMM
+    rb"(?:.{72})"  # not required fields
+    rb"(?P<sea_pres>[0-9]{5})"  # atm pressure relative to mean sea lvl
+    rb"(?:.)"  # quality of the pressure, not used
+    rb"(?:ADD.{0,1000}?MA1"  # id of additional data section, bounded lazy gap up to the first MA1 keeps the scan linear
+    rb"(?:.{6})"  # not required fields
+    rb"(?P<air_pres>[0-9]{5}))?",  # absolute atm pressure
+    re.MULTILINE
+)
+
+
+class Airport(NamedTuple):
     """This represents an airport"""
 
-    def __init__(self):
-        self.name = ""
-        self.longitude = 0.
-        self.latitude = 0.
-
-    def to_tuple(self):
-        return self.name, self.longitude, self.latitude
+    name: str = ""
+    longitude: float = 0.
+    latitude: float = 0.
 
 
-class MeteoStation:
+class MeteoStation(NamedTuple):
     """Represents meteo station that is parsed from NOAA data"""
 
-    def __init__(self, id='999999', longitude=0., latitude=0., elevation=0):
-        self.id = id
-        self.longitude = longitude
-        self.latitude = latitude
-        self.elevation = elevation
+    id: str = '999999'
+    wban_id: str = '99999'
+    longitude: float = 0.
+    latitude: float = 0.
+    elevation: float = 0
 
-    def to_tuple(self):
-        return self.id, self.longitude, self.latitude, self.elevation
 
-class MeteoReading:
+class MeteoReading(NamedTuple):
     """Represents one data point from NOAA data"""
 
-    def __init__(self, station=None, date_time=None, pressure=0):
-        self.station = station
-        self.date_time = date_time
-        self.pressure = pressure
+    station_id: str = '999999'
+    wban_id: str = '99999'
+    date_time: datetime.datetime = None
+    pressure: int = None  # tenths of hPa, None when the station did not report it
+
+
+class MeteoReadings(NamedTuple):
+    """Column-wise store of NOAA data points, one numpy array per field
+
+    pressures is an int16 masked array in tenths of hPa, masked where ISD reports the 99999 missing value
+    or a value outside the valid range
+    """
+
+    station_ids: np.ndarray
+    wban_ids: np.ndarray
+    date_times: np.ndarray
+    pressures: np.ndarray
+
+    @classmethod
+    def from_columns(cls, station=None, date_times=(), pressures=()):
+        """Builds readings of a single MeteoStation from sequences of datetimes and pressures"""
+        return cls(np.full(len(pressures), station.id if station else "", dtype='S6'),
+                   np.full(len(pressures), station.wban_id if station else "", dtype='S5'),
+                   np.array(date_times, dtype='datetime64[m]'),
+                   _mask_missing_pressures(pressures))
+
+    def rows(self):
+        """Yields a MeteoReading per data point"""
+        return map(MeteoReading._make, zip(self.station_ids.astype(str).tolist(), self.wban_ids.astype(str).tolist(),
+                                           self.date_times.tolist(), self.pressures.tolist()))
+
+
+# valid range of ISD pressures in tenths of hPa, MA1 station pressure (04500) goes lower than SLP (08600)
+_ISD_PRESSURE_RANGE = (4500, 10900)
+
+
+def _mask_missing_pressures(pressures):
+    """Turns raw ISD pressures into an int16 masked array
+
+    The 99999 missing value and corrupt values outside the ISD valid range are masked, so none of them are
+    stored as a pressure, and nothing out of int16 range is cast and wrapped around
+    """
+    pressures = np.asarray(pressures, dtype=np.int32)
+    missing = (pressures < _ISD_PRESSURE_RANGE[0]) | (pressures > _ISD_PRESSURE_RANGE[1])
+    return np.ma.array(np.where(missing, 0, pressures).astype(np.int16), mask=missing)
+
 
-    def to_tuple(self):
-        return self.station, self.date_time, self.pressure
+def _parse_isd_station(line):
+    """Builds MeteoStation from the mandatory data section of a raw (bytes) ISD record"""
+    id = line[4:10].decode('ascii')  # station ID in USAF format
+    wban_id = line[10:15].decode('ascii')  # station ID in WBAN format
+    lat = line[28:34].decode('ascii')  # latitude of the coordinate of the station
+    long = line[34:41].decode('ascii')  # longitude of the coordinate of the station
+    elevation = line[46:51].decode('ascii')  # elevation above the sea lvl of the station
+    return MeteoStation(id, wban_id, long, lat, elevation)
+
+
+def _parse_isd_records(data):
+    """Parses raw contents (bytes or mmap) of an ISD file into numpy columns
+
+    Returns (MeteoStation, datetime64[m] array, int32 pressure array) with an entry for every valid record
+    A file holds the readings of a single station, so the station is built from the first valid record only
+    """
+    # one scan over the whole data, malformed records and lines without the mandatory data section do not match
+    records = [(m.start(),) + m.groups(b"") for m in _RE_RECORD.finditer(data)]
+    if not records:
+        return None, np.empty(0, dtype='datetime64[m]'), np.empty(0, dtype=np.int32)
+    starts, dates, times, sea_pressures, add_pressures = zip(*records)
+
+    # the fields are fixed width digits, so they are converted for all records at once instead of one by one
+    date = np.array(dates, dtype='S8').astype(np.int64)
+    time = np.array(times, dtype='S4').astype(np.int64)
+    year, month, day = date // 10000, date // 100 % 100, date % 100
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    days = months.astype('datetime64[D]') + (day - 1)
+    # digits, but not a valid date or time, e.g. day 31 of a 30 day month rolls over into the next month
+    valid = ((month >= 1) & (month <= 12) & (day >= 1) & (days.astype('datetime64[M]') == months)
+             & (time // 100 < 24) & (time % 100 < 60))
+    date_times = days.astype('datetime64[m]') + (time // 100 * 60 + time % 100).astype('timedelta64[m]')
+
+    # absolute atm pressure from the additional data section takes precedence when it is available
+    add_pressures = np.array(add_pressures, dtype='S5')
+    add_pressures[add_pressures == b""] = b"99999"
+    add_pressures = add_pressures.astype(np.int32)
+    pressures = np.where(add_pressures != 99999, add_pressures, np.array(sea_pressures, dtype='S5').astype(np.int32))
+
+    station = None
+    if valid.any():
+        first = starts[valid.argmax()]
+        station = _parse_isd_station(data[first:first + _ISD_MANDATORY_LEN])
+
+    return station, date_times[valid], pressures[valid]
 
 
 class MeteoParser:
     """Parses Integrated Surface Global Hourly Data from NOAA"""
 
     def __init__(self):
-        self.datetime_format = "%Y%m%d%H%M"
         self.date_format = "%Y%m%d"
 
-        # regex for mandatory data, we have to match it since we suppose the beginning of the string
-        self.parse_re_mandatory = re.compile(
-            "(?P<len>[0-9]{4})"  # length of the data
-            "(?P<usaf_id>.{6})"  # station ID in USAF  format
-            "(?P<wban_id>[0-9]{5})"  # station ID in WBAN format
-            "(?P<date>[0-9]{8})"  # date in format YYYYMMDD
-            "(?P<time>[0-9]{4})"  # time in format HHMM
-            "(?:.)"  # data source flag, not used
-            "(?P<lat>(\+|\-)[0-9]{5})"  # latitude of the coordinate of the station
-            "(?P<lon>(\+|\-)[0-9]{6})"  # longitude of the coordinate of the station
-            "(?:.{5})"  # code, not required for our purposes
-            "(?P<elev>(\+|\-)[0-9]{4})"  # elevation above the sea lvl of the station
-            "(?:.{49})"  # not required fields
-            "(?P<air_pres>[0-9]{5})"  # atm pressure relative to mean sea lvl
-        )
-        # regex for additional (optional) data, we have to search it, since additional data is located within the string
-        self.parse_re_add = re.compile(
-            "(?:ADD(.*)?MA1)"  # id of additional data section
-            "(?:.{6})"  # not required fields
-            "(?P<air_pres>[0-9]{5})"  # absolute atm pressure
-        )
-
         # Following is a current format of CSV IDS history file
         # "USAF","WBAN","STATION NAME","CTRY","STATE","ICAO","LAT","LON","ELEV(M)","BEGIN","END"
         self.lat_csv_str = "LAT"
         self.long_csv_str = "LON"
         self.usaf_csv_str = "USAF"
+        self.wban_csv_str = "WBAN"
         self.elev_csv_str = "ELEV(M)"
         self.beg_csv_str = "BEGIN"
         self.end_csv_str = "END"
 
     def parse_files(self, filenames=[]):
-        """Returns {MeteoStation, [MeteoReadings]}"""
+        """Returns {MeteoStation: MeteoReadings}
+
+        Parsing is CPU bound and files are independent, so they are spread over a pool of worker processes
+        """
         result = dict()
-        for file in filenames:
-            readings = self.parse_file(filenames)
-            if len(readings[1]) != 0:
-                result[readings[0]] = readings[1]
+        if not filenames:
+            return result
+
+        with multiprocessing.Pool() as pool:
+            for station, readings in pool.imap_unordered(self.parse_file, filenames, chunksize=4):
+                if len(readings.pressures) != 0:
+                    result[station] = readings
 
         return result
 
     def parse_file(self, filename=""):
-        """Returns (MeteoStation, [MeteoReadings])"""
-
-        readings = []
+        """Returns (MeteoStation, MeteoReadings)"""
 
         if not filename:
-            return []
+            return None, MeteoReadings.from_columns()
         try:
-            with open(filename) as f:
-                for line in f:
-                    mandatory_data_match = self.parse_re_mandatory.match(line)
-
-                    if not mandatory_data_match:
-                        continue  # we do not want this station, no data is available for it
-
-                    id = mandatory_data_match.group('usaf_id')
-                    long = mandatory_data_match.group('lon')
-                    lat = mandatory_data_match.group('lat')
-                    elevation = mandatory_data_match.group('elev')
-                    date = mandatory_data_match.group('date')
-                    time = mandatory_data_match.group('time')
-                    pressure = mandatory_data_match.group('air_pres')
-
-                    add_data_match = self.parse_re_add.search(line)
-                    if add_data_match:
-                        new_pressure = add_data_match.group('air_pres')
-                        if new_pressure != "99999":
-                            pressure = new_pressure
-
-                    # convert date and time into datetime format
-                    dt = datetime.datetime.strptime(date + time, self.datetime_format)
-                    station = MeteoStation(id, long, lat, elevation)
-                    readings.append(MeteoReading(station, dt, pressure))
+            # ISD data is plain ASCII at fixed offsets, the file is mapped and scanned in place without decoding
+            with open(filename, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return None, MeteoReadings.from_columns()  # empty files cannot be mapped
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    station, date_times, pressures = _parse_isd_records(data)
 
         except IOError:
             print("Cannot open file %s" % filename)
-            return []
+            return None, MeteoReadings.from_columns()
 
-        return readings
+        return station, MeteoReadings.from_columns(station, date_times, pressures)
 
     def parse_meteo_stations(self, filename="", end_date=datetime.datetime.now()):
         """Parses CSV IDS history file to extract weather station information
@@ -159,11 +224,12 @@ class MeteoParser:
                     lon = row[self.long_csv_str]
                     elev = row[self.elev_csv_str]
                     usaf_id = row[self.usaf_csv_str]
+                    wban_id = row[self.wban_csv_str]
 
-                    if not (len(lat) and len(lon) and len(elev) and len(usaf_id)):
+                    if not (len(lat) and len(lon) and len(elev) and len(usaf_id) and len(wban_id)):
                         continue
 
-                    stations.append(MeteoStation(usaf_id, lon, lat, elev))
+                    stations.append(MeteoStation(usaf_id, wban_id, lon, lat, elev))
         except IOError:
             print("Cannot open file %s" % filename)
             return []
@@ -179,79 +245,165 @@ class DBConnector:
         self.user = user
 
         self.con = None
+        self.cur = None
         self.airports_populated = False
         self.stations_populated = False
 
         try:
-            self.con = psycopg2.connect(database=dbname, user=user)
+            # transaction() blocks below are then real transactions, each committed as a whole when it ends
+            self.con = psycopg.connect(dbname=dbname, user=user, autocommit=True)
+            # a single cursor is reused by all methods
+            self.cur = self.con.cursor()
             # enable extensions for geo-calculations
-            cur = self.con.cursor()
-            cur.execute("CREATE EXTENSION IF NOT EXISTS cube")
-            cur.execute("CREATE EXTENSION IF NOT EXISTS earthdistance")
+            with self.con.transaction():
+                self.cur.execute("CREATE EXTENSION IF NOT EXISTS cube")
+                self.cur.execute("CREATE EXTENSION IF NOT EXISTS earthdistance")
+                self._create_tables(self.cur)
 
-        except psycopg2.DatabaseError as e:
+        except psycopg.DatabaseError as e:
             print('Error %s' % e)
             sys.exit(1)
 
+    @staticmethod
+    def _create_tables(cur):
+        """Creates the tables that do not exist yet, populate_* methods load into them without touching the schema"""
+        # USAF ids are not unique on their own (all WBAN-only stations use 999999) and not always numeric
+        cur.execute("CREATE TABLE IF NOT EXISTS stations(id SERIAL PRIMARY KEY, usaf_id CHAR(6), wban_id CHAR(5),"
+                    " lon DOUBLE PRECISION, lat DOUBLE PRECISION, elevation DOUBLE PRECISION,"
+                    " UNIQUE (usaf_id, wban_id))")
+        # GiST index over earth coordinates lets closest station lookups run as KNN index scans
+        cur.execute("CREATE INDEX IF NOT EXISTS stations_earth_idx ON stations USING gist (ll_to_earth(lat, lon))")
+        cur.execute("CREATE TABLE IF NOT EXISTS airports(id SERIAL PRIMARY KEY, name VARCHAR(100),"
+                    " lon DOUBLE PRECISION, lat DOUBLE PRECISION, closest_station INTEGER REFERENCES stations)")
+        cur.execute("CREATE TABLE IF NOT EXISTS readings(id SERIAL PRIMARY KEY, station_id INTEGER REFERENCES stations,"
+                    " datetime TIMESTAMP, pressure SMALLINT, UNIQUE (station_id, datetime))")
+
+    @staticmethod
+    def _copy_rows(cur, table, columns, rows):
+        """Bulk loads rows into table with COPY ... FROM STDIN instead of per-row INSERTs"""
+        with cur.copy("COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))) as copy:
+            for row in rows:
+                copy.write_row(row)
+
+    @classmethod
+    def _append_rows(cls, cur, table, columns, rows, key):
+        """Bulk loads rows into table through a temp staging table, rows whose key is already in table are skipped
+
+        Must run inside a transaction, the staging table is dropped when it commits
+        """
+        columns_str = ", ".join(columns)
+        cur.execute("CREATE TEMP TABLE %s_stg ON COMMIT DROP AS SELECT %s FROM %s WITH NO DATA"
+                    % (table, columns_str, table))
+        cls._copy_rows(cur, table + "_stg", columns, rows)
+        cur.execute("INSERT INTO %s (%s) SELECT %s FROM %s_stg ON CONFLICT (%s) DO NOTHING"
+                    % (table, columns_str, columns_str, table, ", ".join(key)))
+
     def populate_airports(self, airports=[]):
+        """Replaces the contents of airports table with airports"""
         if not airports:
             return
         if not self.con:
             raise RuntimeError("Not connected to DB")
         try:
-            cur = self.con.cursor()
-            cur.execute("DROP TABLE IF EXISTS airports")
-            cur.execute("CREATE TABLE airports(id SERIAL PRIMARY KEY, name VARCHAR(100), lon DOUBLE, lat DOUBLE,"
-                        "closest_station INTEGER REFERENCES stations)")
-            query = "INSERT INTO airports (name, lon, lat) VALUES (%s, %s, %s)"
+            with self.con.transaction():
+                # airports have no natural key to merge on, so they are always reloaded as a whole
+                self.cur.execute("TRUNCATE airports RESTART IDENTITY")
+                self._copy_rows(self.cur, "airports", ("name", "lon", "lat"), airports)
+                self.airports_populated = True
 
-            cur.executemany(query, [x.to_tuple() for x in airports])
-            self.airports_populated = True
-
-        except psycopg2.DatabaseError as e:
+        except psycopg.DatabaseError as e:
             print("DB error: Cannot populate airports")
             self.airports_populated = False
             raise
 
-    def populate_meteo_stations(self, stations=[]):
+    def populate_meteo_stations(self, stations=[], truncate=False):
+        """Adds stations to stations table, the ones already present are kept as they are
+
+        Keyword arguments:
+        stations -- MeteoStations to load
+        truncate -- wipe stations table before loading, airports and readings tables are wiped along with it
+
+        """
         if not len(stations):
             return
         if not self.con:
             raise RuntimeError("Not connected to DB")
         try:
-            cur = self.con.cursor()
-            cur.execute("DROP TABLE IF EXISTS stations")
-            cur.execute("CREATE TABLE stations(id SERIAL PRIMARY KEY, usaf_id INTEGER, lon DOUBLE, lat DOUBLE,"
-                        " elevation DOUBLE)")
-            query = "INSERT INTO stations (usaf_id, lon, lat, elevation) VALUES (%s, %s, %s, %s, %s)"
-
-            cur.executemany(query, [x.to_tuple() for x in stations])
-            self.stations_populated = True
-
-        except psycopg2.DatabaseError as e:
+            with self.con.transaction():
+                if truncate:
+                    self.cur.execute("TRUNCATE stations RESTART IDENTITY CASCADE")
+                self._append_rows(self.cur, "stations", ("usaf_id", "wban_id", "lon", "lat", "elevation"),
+                                  stations, ("usaf_id", "wban_id"))
+                self.stations_populated = True
+
+        except psycopg.DatabaseError as e:
             print("DB error: Cannot populate weather stations")
             self.stations_populated = False
             raise
 
-    def populate_meteo_readings(self, readings=[]):
-        if not len(readings):
+    def populate_meteo_readings(self, readings=None, truncate=False):
+        """Adds readings to readings table, the ones already present for a station and time are kept as they are
+
+        Stations have to be loaded with populate_meteo_stations() first, readings of unknown stations are dropped
+
+        Keyword arguments:
+        readings -- MeteoReadings to load
+        truncate -- wipe readings table before loading
+
+        """
+        if readings is None or not len(readings.pressures):
             return
         if not self.con:
             raise RuntimeError("Not connected to DB")
         try:
-            cur = self.con.cursor()
-            cur.execute("DROP TABLE IF EXISTS readings")
-            cur.execute("CREATE TABLE readings(id SERIAL PRIMARY KEY, station_id INTEGER REFERENCES stations,"
-                        " datetime TIMESTAMP, pressure DOUBLE)")
-            query = "INSERT INTO readings (station_id, datetime, pressure) VALUES (%s, %s, %s, %s)"
-
-            cur.executemany(query, [x.to_tuple() for x in readings])
-
-        except psycopg2.DatabaseError as e:
+            with self.con.transaction():
+                if truncate:
+                    self.cur.execute("TRUNCATE readings RESTART IDENTITY")
+                # readings only know the USAF/WBAN ids of their station, resolve the FK once per distinct pair
+                self.cur.execute("SELECT usaf_id || wban_id, id FROM stations")
+                station_keys = dict(self.cur.fetchall())
+                isd_ids, station_idx = np.unique(np.char.add(readings.station_ids, readings.wban_ids),
+                                                 return_inverse=True)
+                keys = np.array([station_keys.get(x, -1) for x in isd_ids.astype(str).tolist()])[station_idx]
+                known = keys >= 0  # readings of stations missing from the table are dropped
+
+                self._append_rows(self.cur, "readings", ("station_id", "datetime", "pressure"),
+                                  zip(keys[known].tolist(), readings.date_times[known].tolist(),
+                                      readings.pressures[known].tolist()),
+                                  ("station_id", "datetime"))
+                # refresh planner statistics once for the whole load
+                self.cur.execute("ANALYZE readings")
+
+        except psycopg.DatabaseError as e:
             print("DB error: Cannot populate weather readings")
             raise
         pass
 
+    def add_meteo_readings(self, readings=None):
+        """Appends MeteoReadings to readings table row by row
+
+        The insert is prepared server-side and the rows are sent in pipeline mode, so there is no roundtrip per row
+        Use populate_meteo_readings() for bulk loads. Stations have to be loaded with populate_meteo_stations()
+        first, readings of unknown stations are dropped
+        """
+        if readings is None or not len(readings.pressures):
+            return
+        if not self.con:
+            raise RuntimeError("Not connected to DB")
+        try:
+            query = ("INSERT INTO readings (station_id, datetime, pressure)"
+                     " SELECT s.id, r.datetime, r.pressure"
+                     " FROM (VALUES (%s::CHAR(6), %s::CHAR(5), %s::TIMESTAMP, %s::SMALLINT))"
+                     " r(usaf_id, wban_id, datetime, pressure)"
+                     " JOIN stations s ON s.usaf_id = r.usaf_id AND s.wban_id = r.wban_id"
+                     " ON CONFLICT (station_id, datetime) DO NOTHING")
+            with self.con.transaction(), self.con.pipeline():
+                self.cur.executemany(query, readings.rows())
+
+        except psycopg.DatabaseError as e:
+            print("DB error: Cannot insert weather readings")
+            raise
+
     def update_airports_with_closest_station(self):
         """Updates airports table by looking up the closest station to each airport
 
@@ -261,6 +413,17 @@ class DBConnector:
 
         if not (self.airports_populated and self.stations_populated):
             return
+        if not self.con:
+            raise RuntimeError("Not connected to DB")
+        try:
+            with self.con.transaction():
+                # single statement, each airport probes stations_earth_idx for its nearest neighbour
+                self.cur.execute("UPDATE airports a SET closest_station = (SELECT s.id FROM stations s"
+                                 " ORDER BY ll_to_earth(s.lat, s.lon) <-> ll_to_earth(a.lat, a.lon) LIMIT 1)")
+
+        except psycopg.DatabaseError as e:
+            print("DB error: Cannot update airports with closest weather station")
+            raise
 
     def get_airports_from_airpressure(self, pressure, time):
         """Lookup the airports that had air pressure similar to the one that is passed around the time"""
@@ -275,12 +438,14 @@ class DBConnector:
             self.con.close()
 
 
-mp = MeteoParser()
-# cur = con.cursor()
-# cur.execute('SELECT version()')
-# ver = cur.fetchone()
-# print(ver)
+if __name__ == "__main__":
+    # worker processes of parse_files() import this module, keep them from running the script
+    mp = MeteoParser()
+    # cur = con.cursor()
+    # cur.execute('SELECT version()')
+    # ver = cur.fetchone()
+    # print(ver)
 
-readings = mp.parse_file("../data/725300-94846-2016")
-stations = mp.parse_meteo_stations("../data/isd-history.csv", datetime.datetime(2016, 12, 1))
+    station, readings = mp.parse_file("../data/725300-94846-2016")
+    stations = mp.parse_meteo_stations("../data/isd-history.csv", datetime.datetime(2016, 12, 1))
 
@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("psycopg")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "db"))
+import db  # noqa: E402
+
+DATA_DIR = os.path.dirname(__file__)
+
+
+def read_record(filename, index):
+    with open(os.path.join(DATA_DIR, filename), 'rb') as f:
+        return f.readlines()[index]
+
+
+def test_malformed_records_are_skipped():
+    lines = [b"x" * 120 + b"\n", b"0" * 15 + b"20161399" + b"0" * 100 + b"\n"]
+    station, date_times, pressures = db._parse_isd_records(b"".join(lines))
+    assert station is None
+    assert len(date_times) == len(pressures) == 0
+
+
+def test_sea_level_pressure_is_read_at_isd_offset():
+    # drop the additional data section so MA1 does not override the sea level pressure
+    line = read_record("062800-99999-2016", 0)[:105] + b"\n"
+    station, date_times, pressures = db._parse_isd_records(line)
+    assert pressures.tolist() == [10206]
+
+
+def test_parse_file_reads_every_record():
+    station, readings = db.MeteoParser().parse_file(os.path.join(DATA_DIR, "062800-99999-2016"))
+    assert (station.id, station.wban_id) == ("062800", "99999")
+    assert len(readings.pressures) == 24211
+    assert readings.pressures[0] == 10202  # MA1 absolute pressure takes precedence
+
+
+def test_missing_pressure_is_masked():
+    readings = db.MeteoReadings.from_columns(db.MeteoStation(), ["2016-01-01T00:00", "2016-01-01T01:00"],
+                                             [10206, 99999])
+    assert readings.pressures.dtype == "int16"
+    assert [r.pressure for r in readings.rows()] == [10206, None]
+
+
+def test_out_of_range_pressure_is_masked():
+    # does not fit int16 and would wrap around into a negative pressure
+    readings = db.MeteoReadings.from_columns(db.MeteoStation(), ["2016-01-01T00:00", "2016-01-01T01:00"],
+                                             [50000, 10206])
+    assert [r.pressure for r in readings.rows()] == [None, 10206]